@@ -1,21 +1,54 @@
 import os
+import io
+import re
+import csv
 import json
 import base64
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters, ContextTypes
+import sys
+import mmap
+import struct
+import heapq
+import pstats
+import cProfile
+import functools
+import tracemalloc
+import hashlib
+import sqlite3
+import time
+import asyncio
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, InlineQueryHandler, filters, ContextTypes
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from collections import Counter
+from collections.abc import Mapping
+from contextlib import closing
 
 # Google Sheets setup - Use environment variables
 SHEET_ID = os.environ.get('SHEET_ID', '1yPXXNyXGNFV_s9kEF6N-bco60lpiPdOTcjnnb0Pwtow')
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 TOKEN = os.environ.get('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 
+# Telegram user IDs allowed to run admin commands, e.g. ADMIN_IDS='12345,67890'
+ADMIN_IDS = {int(uid) for uid in os.environ.get('ADMIN_IDS', '').split(',') if uid.strip()}
+
+# Write plain Critical/GM/O2 values computed by the bot instead of per-row sheet formulas
+COMPUTE_COLUMNS = os.environ.get('COMPUTE_COLUMNS', '').lower() in ('1', 'true', 'yes')
+
+# Sheets served by this process (name -> sheet ID), e.g. SHEETS='{"wardA": "1abc...", "wardB": "1def..."}'
+# Falls back to a single sheet built from SHEET_ID.
+SHEETS = json.loads(os.environ['SHEETS']) if os.environ.get('SHEETS') else {'default': SHEET_ID}
+DEFAULT_SHEET = next(iter(SHEETS))
+
+# Chat or user ID -> sheet name, e.g. CHAT_SHEETS='{"-1001234567890": "wardA", "987654321": "wardB"}'
+CHAT_SHEETS = json.loads(os.environ.get('CHAT_SHEETS', '{}'))
+
 # Column mapping (1-indexed for gspread)
-COL_CRITICAL = 1  # A - Critical/Non-Crit (formula)
-COL_GM = 2  # B - GM Service (formula)
-COL_D = 4  # D - Oxygen Support (formula)
+COL_CRITICAL = 1  # A - Critical/Non-Crit (formula or computed value)
+COL_GM = 2  # B - GM Service (formula or computed value)
+COL_D = 4  # D - Oxygen Support (formula or computed value)
 COL_DISPO = 6  # F - Disposition
 COL_WARD_BED = 8  # H - Ward-Bed
 COL_PATIENT = 9  # I - Patient Entry
@@ -45,13 +78,120 @@ SPECIAL_CATS_MAP = {
     '🌊': 'Overflow'
 }
 
+# Bit for each special category in the selection mask, in SPECIAL_CATS_MAP order
+SPECIAL_CAT_BITS = {emoji: 1 << idx for idx, emoji in enumerate(SPECIAL_CATS_MAP)}
+
+# Special category buttons are built once: (unselected row, selected row) per category
+SPECIAL_CAT_ROWS = [
+    ([InlineKeyboardButton(f"{emoji} - {desc}", callback_data=emoji)],
+     [InlineKeyboardButton(f"✓ {emoji} - {desc}", callback_data=emoji)])
+    for emoji, desc in SPECIAL_CATS_MAP.items()
+]
+SPECIAL_CATS_DONE_ROW = [InlineKeyboardButton("✅ Done", callback_data="done")]
+
+# Taps within this window are coalesced into a single keyboard edit
+SPECIAL_CATS_DEBOUNCE_SECONDS = 0.4
+
 DISPO_OPTIONS = [
     "OLD", "ADMITTED", "HOME", "TOS IN", "TRANS IN FROM ICU",
     "MORT", "TOS OUT", "TRANS OUT TO ICU", "HAMA/HPR", "THOC", "ABSCOND"
 ]
 
-def get_sheet():
+SERVICES = ['GM1', 'GM2', 'GM3', 'GM4', 'GM5', 'GM6']
+
+# Telegram rejects messages longer than this (counted in UTF-16 code units)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Same patterns as the column D formula (REGEXMATCH / REGEXEXTRACT)
+O2_MATCH_PATTERN = re.compile(r'\(?(RA|NC|FM|TM|NRM|HFNC|BIPAP|ET)/')
+O2_EXTRACT_PATTERN = re.compile(r'\(?(RA|NC|FM|TM|NRM|HFNC|BIPAP|ET)')
+
+# Columns written by /export (patient dict key, header)
+EXPORT_FIELDS = [
+    ('row', 'Row'),
+    ('critical', 'Critical'),
+    ('gm_service', 'GM Service'),
+    ('o2_support', 'O2 Support'),
+    ('dispo', 'Disposition'),
+    ('ward_bed', 'Ward-Bed'),
+    ('patient', 'Patient'),
+    ('jric', 'JRIC'),
+    ('cwi', 'CWI')
+]
+
+# Dispositions that add to / subtract from the service census
+ADDITION_DISPOS = ['ADMITTED', 'TOS IN', 'TRANS IN FROM ICU']
+SUBTRACTION_DISPOS = ['HOME', 'TOS OUT', 'TRANS OUT TO ICU', 'HAMA/HPR', 'THOC', 'ABSCOND', 'MORT']
+
+# Change detection - FINGERPRINT_CELL holds a cheap checksum formula, e.g. in Z1:
+#   =SUMPRODUCT(LEN(A2:K)*ROW(A2:K)*COLUMN(A2:K))
+#    &"|"&SUMPRODUCT(UNICODE(LEFT(A2:K&" ",1))*ROW(A2:K)*COLUMN(A2:K))
+#    &"|"&SUMPRODUCT(UNICODE(RIGHT(" "&A2:K,1))*ROW(A2:K)*COLUMN(A2:K))
+#    &"|"&SUMPRODUCT(UNICODE(MID(A2:K&"  ",2,1))*ROW(A2:K)*COLUMN(A2:K))
+# The padding keeps UNICODE() off "" for blank cells, which would turn the whole formula
+# into #VALUE! (an error value is ignored and triggers a full read every time).
+# It covers each cell's length and its first, second and last characters. An edit that
+# keeps all of those (e.g. one letter changed mid-name or mid-CWI) is NOT detected and
+# only shows up when CENSUS_MAX_AGE forces a full read.
+# Leave FINGERPRINT_CELL unset to always do a full read.
+FINGERPRINT_CELL = os.environ.get('FINGERPRINT_CELL', '')
+CENSUS_MAX_AGE = int(os.environ.get('CENSUS_MAX_AGE', '120'))  # Force a full read at least this often
+
+# Last full read of each sheet's census (sheet name -> cache entry), reused while the fingerprint is unchanged
+census_cache = {}
+
+# Opened worksheets by sheet ID, so probes don't re-authorize on every poll
+worksheet_cache = {}
+
+# Daily census history (one row per patient per day), kept locally for /trend and /los
+HISTORY_DB = os.environ.get('HISTORY_DB', 'census_history.db')
+
+# Shared census snapshot for multi-worker deployments:
+#   SNAPSHOT_ROLE=writer - refresh the census and publish it to SNAPSHOT_DIR (or run `python bot.py --snapshot-writer`)
+#   SNAPSHOT_ROLE=reader - read the published snapshot instead of fetching from Sheets
+SNAPSHOT_ROLE = os.environ.get('SNAPSHOT_ROLE', '')
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_REFRESH_SECONDS = int(os.environ.get('SNAPSHOT_REFRESH_SECONDS', '30'))
+
+# Snapshot file layout (little-endian)
+SNAPSHOT_MAGIC = b'GWCS'
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER = struct.Struct('<4sHQI')  # magic, format, version, patient count
+SNAPSHOT_FIELDS = ['id', 'critical', 'gm_service', 'o2_support', 'dispo', 'ward_bed', 'patient', 'jric', 'cwi']
+SNAPSHOT_RECORD = struct.Struct('<I' + 'I' * len(SNAPSHOT_FIELDS))  # row, then byte length of each field
+SNAPSHOT_FIELD_INDEX = {field: idx for idx, field in enumerate(SNAPSHOT_FIELDS)}
+
+# Last snapshot loaded by a reader (sheet name -> file identity, version and patients)
+shared_snapshots = {}
+# Why each reader last fell back to Sheets (sheet name -> reason), so it's logged once rather than per call
+snapshot_fallbacks = {}
+
+# Opt-in handler profiling, switched on at runtime with /profile (admins only)
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', '10'))  # Slowest invocations to keep
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')  # Where /profile dump writes .prof files
+
+profiling = {
+    'enabled': False,
+    'handlers': set(),  # Handler names to profile, empty = all
+    'active': False,  # Only one cProfile/tracemalloc session can run at a time
+    'slowest': [],  # Min-heap of (wall seconds, sequence, record)
+    'sequence': 0
+}
+
+# Inline search settings
+INLINE_MAX_RESULTS = 20  # Telegram shows at most 50, keep the list short on phones
+INLINE_CACHE_SIZE = 512  # Max cached query prefixes before the cache is reset
+INDEX_REFRESH_SECONDS = int(os.environ.get('INDEX_REFRESH_SECONDS', '60'))
+
+# In-process indexes of the parsed census used by inline queries (sheet name -> index)
+patient_indexes = {}
+
+def get_sheet(sheet=DEFAULT_SHEET):
     """Initialize and return Google Sheets client"""
+    sheet_id = SHEETS[sheet]
+    if sheet_id in worksheet_cache:
+        return worksheet_cache[sheet_id]
+    
     try:
         creds = None
         
@@ -110,7 +250,7 @@ def get_sheet():
         client = gspread.authorize(creds)
         print("✓ gspread authorized successfully")
         
-        spreadsheet = client.open_by_key(SHEET_ID)
+        spreadsheet = client.open_by_key(sheet_id)
         print(f"✓ Spreadsheet opened: {spreadsheet.title}")
         
         # Debug: Print all available worksheet names
@@ -131,6 +271,7 @@ def get_sheet():
             try:
                 worksheet = spreadsheet.worksheet(name)
                 print(f"✓ Using worksheet: '{name}'")
+                worksheet_cache[sheet_id] = worksheet
                 return worksheet
             except:
                 continue
@@ -138,6 +279,7 @@ def get_sheet():
         # If none found, use the first worksheet
         worksheet = spreadsheet.get_worksheet(0)
         print(f"⚠ Using first worksheet: '{worksheet.title}'")
+        worksheet_cache[sheet_id] = worksheet
         return worksheet
         
     except Exception as e:
@@ -146,41 +288,113 @@ def get_sheet():
         traceback.print_exc()
         raise
 
-def get_all_patients():
-    """Get all patient data from the sheet"""
+# ============ CHANGE DETECTION ============
+
+class SheetFingerprintProbe:
+    """Reads the checksum cell maintained by a formula in the sheet (one tiny API call)"""
+    
+    def __init__(self, cell=FINGERPRINT_CELL):
+        self.cell = cell
+    
+    def fingerprint(self, sheet=DEFAULT_SHEET):
+        """Return the current fingerprint, or None if it can't be determined"""
+        if not self.cell:
+            return None
+        try:
+            value = get_sheet(sheet).acell(self.cell).value
+        except Exception as e:
+            print(f"⚠ Fingerprint probe failed, falling back to full read: {e}")
+            return None
+        # A broken formula shows a constant error (#VALUE!, #REF!...) - never trust it
+        if not value or value.startswith('#'):
+            return None
+        return value
+
+class LocalFingerprintProbe:
+    """In-memory stand-in for tests and local runs; call bump() to simulate an edit"""
+    
+    def __init__(self):
+        self.values = {}
+    
+    def fingerprint(self, sheet=DEFAULT_SHEET):
+        return str(self.values.get(sheet, 0))
+    
+    def bump(self, sheet=DEFAULT_SHEET):
+        self.values[sheet] = self.values.get(sheet, 0) + 1
+
+fingerprint_probe = SheetFingerprintProbe()
+
+def set_fingerprint_probe(probe):
+    """Swap the change-detection probe (anything with a fingerprint() method)"""
+    global fingerprint_probe
+    fingerprint_probe = probe
+    for sheet in SHEETS:
+        invalidate_census(sheet)
+
+def refresh_worksheet(sheet=DEFAULT_SHEET):
+    """Reopen a cached worksheet so row_count reflects rows added in the Sheets UI"""
+    ws = get_sheet(sheet)
+    fresh = ws.spreadsheet.get_worksheet_by_id(ws.id)
+    worksheet_cache[SHEETS[sheet]] = fresh
+    return fresh
+
+def get_census_cache(sheet):
+    if sheet not in census_cache:
+        census_cache[sheet] = {
+            'fingerprint': None,
+            'patients': [],
+            'rows': {},  # Patient ID -> current sheet row, for IDs that appear once
+            'ambiguous': set(),  # IDs shared by several rows (e.g. blank case numbers)
+            'stale': False,  # Set when the bot itself wrote to the sheet
+            'version': 0,  # time_ns when the cached data was read from Sheets
+            'invalidated_at': 0,  # time_ns of the bot's last own write
+            'fetched_at': 0.0
+        }
+    return census_cache[sheet]
+
+def invalidate_census(sheet=DEFAULT_SHEET):
+    """Force the next get_all_patients() call for this sheet to do a full read"""
+    cache = get_census_cache(sheet)
+    cache['fingerprint'] = None
+    cache['stale'] = True
+    cache['invalidated_at'] = time.time_ns()
+
+def cached_patients(sheet=DEFAULT_SHEET):
+    """Return the in-process census if it is fresh enough to serve without Sheets, else None"""
+    cache = get_census_cache(sheet)
+    if cache['fetched_at'] and not cache['stale'] and time.time() - cache['fetched_at'] < CENSUS_MAX_AGE:
+        return cache['patients']
+    return None
+
+def get_all_patients(sheet=DEFAULT_SHEET):
+    """Get all patient data from the sheet, skipping the full read if nothing changed.
+    
+    The returned list is shared with the cache - treat it as read-only.
+    """
     try:
-        ws = get_sheet()
-        all_values = ws.get_all_values()
-        
-        print(f"Total rows in sheet: {len(all_values)}")
-        print(f"Sheet columns: {len(all_values[0]) if all_values else 0}")
-        
-        # Skip header row (assuming row 1 is header)
-        patients = []
-        for idx, row in enumerate(all_values[1:], start=2):
-            # Make sure row has enough columns and patient data exists
-            if len(row) > COL_PATIENT and row[COL_PATIENT-1] and str(row[COL_PATIENT-1]).strip():
-                patients.append({
-                    'row': idx,
-                    'critical': row[COL_CRITICAL-1] if len(row) >= COL_CRITICAL and row[COL_CRITICAL-1] else '',
-                    'gm_service': row[COL_GM-1] if len(row) >= COL_GM and row[COL_GM-1] else '',
-                    'o2_support': row[COL_D-1] if len(row) >= COL_D and row[COL_D-1] else '',
-                    'dispo': row[COL_DISPO-1] if len(row) >= COL_DISPO and row[COL_DISPO-1] else '',
-                    'ward_bed': row[COL_WARD_BED-1] if len(row) >= COL_WARD_BED and row[COL_WARD_BED-1] else '',
-                    'patient': str(row[COL_PATIENT-1]).strip(),
-                    'jric': row[COL_JRIC-1] if len(row) >= COL_JRIC and row[COL_JRIC-1] else '',
-                    'cwi': row[COL_CWI-1] if len(row) >= COL_CWI and row[COL_CWI-1] else ''
-                })
-        
-        print(f"Found {len(patients)} patients in column I (COL_PATIENT={COL_PATIENT})")
-        if patients:
-            print(f"First patient: {patients[0]['patient'][:50]}...")
+        cache = get_census_cache(sheet)
+        
+        # Worker processes take the census published by the writer instead of calling Sheets
+        if SNAPSHOT_ROLE == 'reader':
+            snapshot = load_shared_snapshot(sheet)
+            if snapshot is not None:
+                version, patients = snapshot
+                # Skip a snapshot read before this worker's own last write or read
+                if version > cache['version'] and version > cache['invalidated_at']:
+                    store_census(sheet, patients, version=version)
+                if not cache['stale']:
+                    return cache['patients']
+        
+        fingerprint = fingerprint_probe.fingerprint(sheet)
+        if (fingerprint is not None and fingerprint == cache['fingerprint']
+                and time.time() - cache['fetched_at'] < CENSUS_MAX_AGE):
+            patients = cache['patients']
         else:
-            print("No patients found. Checking column I data:")
-            for idx, row in enumerate(all_values[:5], start=1):
-                col_i_value = row[COL_PATIENT-1] if len(row) >= COL_PATIENT else "N/A"
-                print(f"  Row {idx}, Column I: '{col_i_value}'")
+            patients = read_census(sheet, fingerprint)
         
+        # Tell readers the writer is alive and the snapshot is current
+        if SNAPSHOT_ROLE == 'writer':
+            touch_snapshot(sheet)
         return patients
     except Exception as e:
         print(f"Error in get_all_patients: {e}")
@@ -188,6 +402,447 @@ def get_all_patients():
         traceback.print_exc()
         return []
 
+def read_census(sheet=DEFAULT_SHEET, fingerprint=None):
+    """Do a full read of the sheet and refresh the cache, history and shared snapshot"""
+    version = time.time_ns()
+    ws = get_sheet(sheet)
+    all_values = ws.get_all_values()
+    
+    print(f"Total rows in sheet '{sheet}': {len(all_values)}")
+    print(f"Sheet columns: {len(all_values[0]) if all_values else 0}")
+    
+    # Skip header row (assuming row 1 is header)
+    patients = []
+    for idx, row in enumerate(all_values[1:], start=2):
+        # Make sure row has enough columns and patient data exists
+        if len(row) > COL_PATIENT and row[COL_PATIENT-1] and str(row[COL_PATIENT-1]).strip():
+            if COMPUTE_COLUMNS:
+                # Columns A/B/D hold plain values that go stale when column I is edited in the sheet
+                critical, gm_service, o2_support = computed_columns(str(row[COL_PATIENT-1]).strip())
+            else:
+                critical = row[COL_CRITICAL-1] if len(row) >= COL_CRITICAL and row[COL_CRITICAL-1] else ''
+                gm_service = row[COL_GM-1] if len(row) >= COL_GM and row[COL_GM-1] else ''
+                o2_support = row[COL_D-1] if len(row) >= COL_D and row[COL_D-1] else ''
+            patients.append({
+                'id': patient_id(row[COL_PATIENT-1]),
+                'row': idx,
+                'critical': critical,
+                'gm_service': gm_service,
+                'o2_support': o2_support,
+                'dispo': row[COL_DISPO-1] if len(row) >= COL_DISPO and row[COL_DISPO-1] else '',
+                'ward_bed': row[COL_WARD_BED-1] if len(row) >= COL_WARD_BED and row[COL_WARD_BED-1] else '',
+                'patient': str(row[COL_PATIENT-1]).strip(),
+                'jric': row[COL_JRIC-1] if len(row) >= COL_JRIC and row[COL_JRIC-1] else '',
+                'cwi': row[COL_CWI-1] if len(row) >= COL_CWI and row[COL_CWI-1] else ''
+            })
+    
+    print(f"Found {len(patients)} patients in column I (COL_PATIENT={COL_PATIENT})")
+    if patients:
+        print(f"First patient: {patients[0]['patient'][:50]}...")
+    else:
+        print("No patients found. Checking column I data:")
+        for idx, row in enumerate(all_values[:5], start=1):
+            col_i_value = row[COL_PATIENT-1] if len(row) >= COL_PATIENT else "N/A"
+            print(f"  Row {idx}, Column I: '{col_i_value}'")
+    
+    record_snapshot(sheet, patients)
+    if SNAPSHOT_ROLE == 'writer':
+        publish_snapshot(sheet, patients, version)
+    
+    store_census(sheet, patients, fingerprint, version)
+    return patients
+
+def store_census(sheet, patients, fingerprint=None, version=None):
+    """Make patients the cached census of a sheet and rebuild its ID -> row index"""
+    cache = get_census_cache(sheet)
+    cache['fingerprint'] = fingerprint
+    cache['version'] = version or time.time_ns()
+    cache['patients'] = patients
+    cache['stale'] = False
+    cache['rows'] = {}
+    cache['ambiguous'] = set()
+    for p in patients:
+        if p['id'] in cache['rows']:
+            cache['ambiguous'].add(p['id'])
+        cache['rows'][p['id']] = p['row']
+    for pid in cache['ambiguous']:
+        del cache['rows'][pid]
+    if cache['ambiguous']:
+        print(f"⚠ {len(cache['ambiguous'])} patient ID(s) in '{sheet}' are shared by several rows")
+    cache['fetched_at'] = time.time()
+
+# ============ SHARED SNAPSHOT ============
+
+def snapshot_path(sheet):
+    safe_name = re.sub(r'[^\w-]', '_', sheet)
+    return os.path.join(SNAPSHOT_DIR, f"census_{safe_name}.bin")
+
+def encode_snapshot(patients, version):
+    """Pack patients as: header, then per patient a fixed record (row + field byte lengths) and the UTF-8 fields"""
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, version, len(patients))]
+    for p in patients:
+        fields = [p[field].encode('utf-8') for field in SNAPSHOT_FIELDS]
+        parts.append(SNAPSHOT_RECORD.pack(p['row'], *(len(f) for f in fields)))
+        parts.extend(fields)
+    return b''.join(parts)
+
+def read_snapshot_version(view):
+    """Return the snapshot version from the header of a mapped snapshot"""
+    magic, fmt, version, _ = SNAPSHOT_HEADER.unpack_from(view, 0)
+    if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT:
+        raise ValueError("Not a census snapshot (or written by a different bot version)")
+    return version
+
+class SnapshotRecord(Mapping):
+    """Read-only patient record that decodes a field from the mapped snapshot only when accessed"""
+    
+    __slots__ = ('_view', '_offset')
+    
+    def __init__(self, view, offset):
+        self._view = view
+        self._offset = offset
+    
+    def __getitem__(self, key):
+        row, *lengths = SNAPSHOT_RECORD.unpack_from(self._view, self._offset)
+        if key == 'row':
+            return row
+        idx = SNAPSHOT_FIELD_INDEX[key]
+        start = self._offset + SNAPSHOT_RECORD.size + sum(lengths[:idx])
+        return str(self._view[start:start + lengths[idx]], 'utf-8')
+    
+    def __iter__(self):
+        return iter(['row', *SNAPSHOT_FIELDS])
+    
+    def __len__(self):
+        return len(SNAPSHOT_FIELDS) + 1
+
+def decode_snapshot(view):
+    """Return lazy records over a mapped snapshot - only the record headers are read here"""
+    _, _, _, count = SNAPSHOT_HEADER.unpack_from(view, 0)
+    offset = SNAPSHOT_HEADER.size
+    patients = []
+    for _ in range(count):
+        _, *lengths = SNAPSHOT_RECORD.unpack_from(view, offset)
+        patients.append(SnapshotRecord(view, offset))
+        offset += SNAPSHOT_RECORD.size + sum(lengths)
+    return patients
+
+def publish_snapshot(sheet, patients, version):
+    """Atomically replace the shared snapshot of a sheet"""
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        path = snapshot_path(sheet)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(encode_snapshot(patients, version))
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"⚠ Could not publish census snapshot: {e}")
+
+def touch_snapshot(sheet):
+    """Bump the snapshot's mtime - readers treat an old mtime as a dead writer"""
+    try:
+        os.utime(snapshot_path(sheet))
+    except OSError:
+        pass
+
+def load_shared_snapshot(sheet):
+    """Return (version, patients) published by the writer, or None if there is no live snapshot.
+    
+    Only a stat() and a header read happen per call. A new version is mapped
+    and wrapped in lazy records; fields are decoded straight from the mapping
+    when accessed. A snapshot the writer hasn't touched for CENSUS_MAX_AGE is
+    ignored, so workers fall back to Sheets if the writer dies.
+    """
+    path = snapshot_path(sheet)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return snapshot_fallback(sheet, "there is no shared snapshot yet")
+    
+    if time.time_ns() - st.st_mtime_ns > CENSUS_MAX_AGE * 1_000_000_000:
+        return snapshot_fallback(sheet, f"the shared snapshot is older than {CENSUS_MAX_AGE}s")
+    
+    entry = shared_snapshots.get(sheet)
+    file_key = (st.st_ino, st.st_size)
+    if entry and entry['file'] == file_key:
+        snapshot_fallbacks.pop(sheet, None)
+        return entry['version'], entry['patients']
+    
+    try:
+        with open(path, 'rb') as f:
+            # The mapping stays open for as long as any record refers to it
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        version = read_snapshot_version(view)
+        if entry and entry['version'] == version:
+            entry['file'] = file_key
+            return version, entry['patients']
+        patients = decode_snapshot(view)
+    except FileNotFoundError:
+        return snapshot_fallback(sheet, "there is no shared snapshot yet")
+    except (ValueError, struct.error) as e:
+        # Damaged file, or one published by another bot version
+        return snapshot_fallback(sheet, f"the shared snapshot is unreadable ({e})")
+    
+    shared_snapshots[sheet] = {'file': file_key, 'version': version, 'patients': patients}
+    snapshot_fallbacks.pop(sheet, None)
+    print(f"Mapped shared snapshot for '{sheet}': {len(patients)} patients (version {version})")
+    return version, patients
+
+def snapshot_fallback(sheet, reason):
+    """Log why a reader can't use the shared snapshot (once per change of reason) and return None"""
+    if snapshot_fallbacks.get(sheet) != reason:
+        snapshot_fallbacks[sheet] = reason
+        print(f"⚠ Reading '{sheet}' from Sheets directly: {reason}")
+    return None
+
+async def snapshot_writer_loop():
+    """Keep the shared snapshots fresh for reader processes (cheap while fingerprints are unchanged)"""
+    while True:
+        await fetch_all_sheets()
+        await asyncio.sleep(SNAPSHOT_REFRESH_SECONDS)
+
+# ============ CENSUS HISTORY ============
+
+def open_history():
+    """Open the history store, creating the table and indexes on first use"""
+    conn = sqlite3.connect(HISTORY_DB)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS census (
+            day TEXT NOT NULL,
+            sheet TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            patient_id TEXT NOT NULL,
+            gm_service TEXT,
+            dispo TEXT,
+            critical TEXT,
+            o2_support TEXT,
+            jric TEXT,
+            ward_bed TEXT,
+            patient TEXT,
+            PRIMARY KEY (sheet, day, row)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS census_by_service ON census (sheet, gm_service, day)")
+    conn.execute("CREATE INDEX IF NOT EXISTS census_by_patient ON census (sheet, patient_id, day)")
+    return conn
+
+def record_snapshot(sheet, patients, day=None):
+    """Store today's census for a sheet, replacing any earlier snapshot from the same day"""
+    day = day or date.today().isoformat()
+    try:
+        with closing(open_history()) as conn, conn:
+            conn.execute("DELETE FROM census WHERE sheet = ? AND day = ?", (sheet, day))
+            # Rows are unique within a snapshot, so a plain INSERT never drops a patient
+            conn.executemany(
+                "INSERT INTO census VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((day, sheet, p['row'], p['id'], p['gm_service'], p['dispo'], p['critical'],
+                  p['o2_support'], p['jric'], p['ward_bed'], p['patient']) for p in patients)
+            )
+    except Exception as e:
+        # History is best-effort - never fail a census read because of it
+        print(f"⚠ Could not record census snapshot: {e}")
+
+def census_trend(sheet, service, days):
+    """Return [(day, old, additions, subtractions)] for a service over the last N days"""
+    since = (date.today() - timedelta(days=days - 1)).isoformat()
+    adds = ','.join('?' * len(ADDITION_DISPOS))
+    subs = ','.join('?' * len(SUBTRACTION_DISPOS))
+    query = f"""
+        SELECT day,
+               SUM(dispo = 'OLD'),
+               SUM(dispo IN ({adds})),
+               SUM(dispo IN ({subs}))
+        FROM census
+        WHERE sheet = ? AND day >= ?{' AND gm_service = ?' if service != 'ALL' else ''}
+        GROUP BY day
+        ORDER BY day
+    """
+    params = [*ADDITION_DISPOS, *SUBTRACTION_DISPOS, sheet, since]
+    if service != 'ALL':
+        params.append(service)
+    with closing(open_history()) as conn:
+        return conn.execute(query, params).fetchall()
+
+def lengths_of_stay(sheet, keyword=''):
+    """Return [(days, patient)] for patients in the latest snapshot, longest stay first"""
+    with closing(open_history()) as conn:
+        # One result per row of the latest snapshot, so patients sharing an ID are all listed
+        rows = conn.execute("""
+            SELECT CAST(julianday(latest.day) - julianday((
+                       SELECT MIN(day) FROM census AS seen
+                       WHERE seen.sheet = latest.sheet AND seen.patient_id = latest.patient_id
+                   )) AS INTEGER) + 1,
+                   latest.patient
+            FROM census AS latest
+            WHERE latest.sheet = ? AND latest.day = (SELECT MAX(day) FROM census WHERE sheet = ?)
+            ORDER BY 1 DESC, latest.patient
+        """, (sheet, sheet)).fetchall()
+    keyword = keyword.lower()
+    return [(days, patient) for days, patient in rows if keyword in patient.lower()]
+
+# ============ PATIENT IDS ============
+
+def patient_id(patient_str):
+    """Stable ID for a patient, derived from the last name and case number/passcode of the entry.
+    
+    Case numbers can be blank or repeated, so an ID is not guaranteed to be
+    unique - store_census() tracks the ones that are shared.
+    """
+    # Format: GM#/LastName (O2/COVID) - CASE/PASSCODE - Ward-Bed [JRIC] ...
+    patient_str = str(patient_str).strip()
+    parts = patient_str.split(' - ')
+    if len(parts) >= 2:
+        key = f"{get_last_name(patient_str).lower()}|{parts[1].strip()}"
+    else:
+        key = patient_str
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=6).hexdigest()
+
+def index_patient_row(sheet, pid, row):
+    """Record a patient's row after the bot writes it, without re-reading the sheet"""
+    cache = get_census_cache(sheet)
+    if pid in cache['rows'] or pid in cache['ambiguous']:
+        cache['rows'].pop(pid, None)
+        cache['ambiguous'].add(pid)
+    else:
+        cache['rows'][pid] = row
+
+def resolve_patient_row(sheet, pid, entry, row_hint=None):
+    """Return the current row of a patient, or None if it can't be identified safely.
+    
+    The indexed row is confirmed by reading that single cell and comparing it
+    with the entry the user picked; only if the rows have moved since the
+    index was built is the sheet re-read. IDs shared by several rows are only
+    trusted together with the explicit row (row_hint) the user picked.
+    """
+    ws = get_sheet(sheet)
+    cache = get_census_cache(sheet)
+    row = row_hint if pid in cache['ambiguous'] else cache['rows'].get(pid)
+    if row is not None and (ws.cell(row, COL_PATIENT).value or '').strip() == entry:
+        return row
+    
+    print(f"⚠ Row index conflict for patient {pid} in '{sheet}', re-reading sheet")
+    patients = read_census(sheet)
+    matches = [p['row'] for p in patients if p['id'] == pid]
+    if len(matches) == 1:
+        return matches[0]
+    
+    # Several rows share this ID - only an exact, unique entry match is safe to write
+    exact = [p['row'] for p in patients if p['id'] == pid and p['patient'] == entry]
+    return exact[0] if len(exact) == 1 else None
+
+async def fetch_all_sheets(sheets=None):
+    """Fetch several sheets concurrently, returning {sheet name: patients}"""
+    sheets = list(sheets or SHEETS)
+    results = await asyncio.gather(*(asyncio.to_thread(get_all_patients, sheet) for sheet in sheets))
+    return dict(zip(sheets, results))
+
+def sheet_for(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Resolve which sheet the current chat or user works on"""
+    # A choice made with /sheet in this chat wins over the static mapping
+    if context.chat_data is not None and context.chat_data.get('sheet') in SHEETS:
+        return context.chat_data['sheet']
+    for entity in (update.effective_chat, update.effective_user):
+        if entity and CHAT_SHEETS.get(str(entity.id)) in SHEETS:
+            return CHAT_SHEETS[str(entity.id)]
+    return DEFAULT_SHEET
+
+# ============ INLINE SEARCH INDEX ============
+
+def get_last_name(patient_str):
+    """Extract last name from a patient string (format: GM#/LastName (...))"""
+    parts = patient_str.split('/')
+    if len(parts) >= 2:
+        return parts[1].split('(')[0].strip()
+    return ""
+
+def get_patient_index(sheet):
+    if sheet not in patient_indexes:
+        patient_indexes[sheet] = {
+            'patients': [],
+            'haystacks': [],  # Lowercased searchable text, parallel to 'patients'
+            'last_names': [],  # Lowercased last names, parallel to 'patients'
+            'cache': {},  # Query prefix -> ranked positions into 'patients'
+            'version': 0,
+            'loaded_at': 0.0,
+            'refreshing': False
+        }
+    return patient_indexes[sheet]
+
+def build_patient_index(patients, sheet=DEFAULT_SHEET):
+    """Replace a sheet's inline search index with a freshly parsed census"""
+    patient_index = get_patient_index(sheet)
+    patient_index['patients'] = patients
+    patient_index['haystacks'] = [
+        ' '.join([p['patient'], p['jric'], p['ward_bed'], p['cwi']]).lower() for p in patients
+    ]
+    patient_index['last_names'] = [get_last_name(p['patient']).lower() for p in patients]
+    patient_index['version'] += 1
+    patient_index['loaded_at'] = time.time()
+    patient_index['cache'].clear()
+    print(f"Patient index for '{sheet}' rebuilt: {len(patients)} patients (version {patient_index['version']})")
+
+def patient_index_is_stale(sheet=DEFAULT_SHEET):
+    return time.time() - get_patient_index(sheet)['loaded_at'] > INDEX_REFRESH_SECONDS
+
+async def refresh_patient_index(sheet=DEFAULT_SHEET):
+    """Reload the index in a worker thread so the event loop never waits on Sheets"""
+    patient_index = get_patient_index(sheet)
+    if patient_index['refreshing']:
+        return
+    patient_index['refreshing'] = True
+    try:
+        patients = await asyncio.to_thread(get_all_patients, sheet)
+        if patients and patients is not patient_index['patients']:
+            build_patient_index(patients, sheet)
+        else:
+            # Keep serving the old index, but don't hammer Sheets on every keystroke
+            patient_index['loaded_at'] = time.time()
+    finally:
+        patient_index['refreshing'] = False
+
+def search_patient_index(query, sheet=DEFAULT_SHEET):
+    """Return ranked positions of patients matching every term in query"""
+    patient_index = get_patient_index(sheet)
+    inline_cache = patient_index['cache']
+    query = ' '.join(query.lower().split())
+    if query in inline_cache:
+        return inline_cache[query]
+    
+    # Matches for a longer query are always a subset of the matches for its
+    # prefix, so narrow down from the longest cached prefix instead of rescanning
+    candidates = None
+    for end in range(len(query) - 1, 0, -1):
+        if query[:end] in inline_cache:
+            candidates = inline_cache[query[:end]]
+            break
+    if candidates is None:
+        candidates = range(len(patient_index['patients']))
+    
+    terms = query.split()
+    haystacks = patient_index['haystacks']
+    last_names = patient_index['last_names']
+    
+    scored = []
+    for pos in candidates:
+        haystack = haystacks[pos]
+        if all(term in haystack for term in terms):
+            # Rank last-name prefix matches first, then word-prefix matches
+            if last_names[pos].startswith(terms[0]):
+                score = 0
+            elif any(word.startswith(terms[0]) for word in haystack.split()):
+                score = 1
+            else:
+                score = 2
+            scored.append((score, last_names[pos], pos))
+    scored.sort()
+    
+    if len(inline_cache) >= INLINE_CACHE_SIZE:
+        inline_cache.clear()
+    inline_cache[query] = [pos for _, _, pos in scored]
+    return inline_cache[query]
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command handler"""
     await update.message.reply_text(
@@ -196,11 +851,252 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/add - Add a new patient\n"
         "/dispo - Update patient disposition\n"
         "/search - Search for a patient\n"
-        "/servicereport - Generate service report\n"
-        "/galawardsreport - Generate Gala Wards report\n"
-        "/cancel - Cancel current operation"
+        "/servicereport - Generate service report (add 'all' for every GM service)\n"
+        "/galawardsreport - Generate Gala Wards report (add 'all' to combine every ward)\n"
+        "/sheet - Show or switch the ward sheet for this chat\n"
+        "/trend - Census trend, e.g. /trend GM3 30d\n"
+        "/los - Length of stay of current patients\n"
+        "/export - Download the census as CSV/XLSX, e.g. /export xlsx GM3\n"
+        "/cancel - Cancel current operation\n\n"
+        "Type @<bot username> followed by a name in any chat to search inline."
     )
 
+def is_admin(update: Update):
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
+# ============ PROFILING ============
+
+def profiled(func):
+    """Wrap a handler so it runs under cProfile and tracemalloc while profiling is on"""
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        if (not profiling['enabled'] or profiling['active']
+                or (profiling['handlers'] and func.__name__ not in profiling['handlers'])):
+            return await func(update, context)
+        
+        # Other handlers that run while this one awaits are counted in its profile too
+        profiling['active'] = True
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            return await func(update, context)
+        finally:
+            profiler.disable()
+            wall = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+            profiling['active'] = False
+            record_profile(func.__name__, wall, peak, profiler)
+    return wrapper
+
+def record_profile(name, wall, peak, profiler):
+    """Keep the invocation if it is among the PROFILE_TOP_N slowest so far"""
+    profiling['sequence'] += 1
+    record = {
+        'handler': name,
+        'wall': wall,
+        'peak': peak,
+        'at': datetime.now(),
+        'stats': pstats.Stats(profiler)
+    }
+    entry = (wall, profiling['sequence'], record)
+    if len(profiling['slowest']) < PROFILE_TOP_N:
+        heapq.heappush(profiling['slowest'], entry)
+    else:
+        heapq.heappushpop(profiling['slowest'], entry)
+
+def install_profiling(application):
+    """Wrap every registered handler callback, including those inside conversations"""
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for state_handlers in handler.states.values():
+                for h in state_handlers:
+                    wrap(h)
+            for h in handler.entry_points + handler.fallbacks:
+                wrap(h)
+        else:
+            handler.callback = profiled(handler.callback)
+    
+    for group in application.handlers.values():
+        for handler in group:
+            wrap(handler)
+
+def hotspots(stats, limit=5):
+    """Return [(own seconds, cumulative seconds, 'func (file:line)')] sorted by own time"""
+    rows = []
+    for (filename, line, func_name), (_, _, own, cumulative, _) in stats.stats.items():
+        rows.append((own, cumulative, f"{func_name} ({os.path.basename(filename)}:{line})"))
+    rows.sort(reverse=True)
+    return rows[:limit]
+
+def profile_report():
+    """Summarize the slowest profiled invocations as a hotspot table"""
+    records = [record for _, _, record in sorted(profiling['slowest'], reverse=True)]
+    if not records:
+        return "No profiled invocations yet."
+    
+    report = f"SLOWEST {len(records)} HANDLER CALLS\n\n"
+    for idx, record in enumerate(records, 1):
+        report += (f"{idx}. {record['handler']} {record['wall'] * 1000:.0f} ms, "
+                   f"peak {record['peak'] / 1024:.0f} KB ({record['at'].strftime('%H:%M:%S')})\n")
+        for own, cumulative, where in hotspots(record['stats']):
+            report += f"   {own * 1000:7.1f} / {cumulative * 1000:7.1f} ms  {where}\n"
+        report += "\n"
+    report += "(own / cumulative time per function)"
+    return report
+
+def dump_profiles():
+    """Write the kept profiles and the summary table to PROFILE_DIR, returning the file count"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    records = [record for _, _, record in profiling['slowest']]
+    for record in records:
+        filename = f"{record['at'].strftime('%Y%m%d_%H%M%S_%f')}_{record['handler']}.prof"
+        record['stats'].dump_stats(os.path.join(PROFILE_DIR, filename))
+    with open(os.path.join(PROFILE_DIR, 'summary.txt'), 'w', encoding='utf-8') as f:
+        f.write(profile_report())
+    return len(records)
+
+# ============ COMPUTED COLUMNS ============
+
+def computed_columns(patient_entry):
+    """Return (critical, gm_service, o2_support) - what the column A, B and D formulas evaluate to"""
+    if not patient_entry:
+        return '', '', ''
+    
+    critical = 'Critical' if ('🚨' in patient_entry or '😱' in patient_entry) else 'Non-Crit'
+    gm = patient_entry[:3]
+    o2 = ''
+    if O2_MATCH_PATTERN.search(patient_entry):
+        o2 = O2_EXTRACT_PATTERN.search(patient_entry).group(1)
+    return critical, gm, o2
+
+def replace_formulas_with_values(sheet=DEFAULT_SHEET):
+    """Overwrite the Critical/GM/O2 formulas of every patient row with computed values in one batch.
+    
+    Empty rows keep their formulas, so patients typed straight into the sheet still get A/B/D.
+    """
+    ws = get_sheet(sheet)
+    all_values = ws.get_all_values()
+    
+    # Group consecutive patient rows into runs so each run is one range
+    runs = []
+    for idx, row in enumerate(all_values[1:], start=2):
+        entry = str(row[COL_PATIENT-1]).strip() if len(row) >= COL_PATIENT else ''
+        if not entry:
+            continue
+        if runs and runs[-1][1] == idx - 1:
+            runs[-1][1] = idx
+            runs[-1][2].append(computed_columns(entry))
+        else:
+            runs.append([idx, idx, [computed_columns(entry)]])
+    if not runs:
+        return 0
+    
+    data = []
+    for first, last, computed in runs:
+        data.append({
+            'range': f"{rowcol_to_a1(first, COL_CRITICAL)}:{rowcol_to_a1(last, COL_GM)}",
+            'values': [[critical, gm] for critical, gm, _ in computed]
+        })
+        data.append({
+            'range': f"{rowcol_to_a1(first, COL_D)}:{rowcol_to_a1(last, COL_D)}",
+            'values': [[o2] for _, _, o2 in computed]
+        })
+    ws.batch_update(data, value_input_option='RAW')
+    
+    invalidate_census(sheet)
+    return sum(len(computed) for _, _, computed in runs)
+
+# ============ EXPORT ============
+
+def export_rows(patients, service=None, jric=None, dispo=None):
+    """Yield export rows for the patients matching the optional filters"""
+    for p in patients:
+        if service and p['gm_service'] != service:
+            continue
+        if jric and p['jric'].lower() != jric.lower():
+            continue
+        if dispo and p['dispo'] != dispo:
+            continue
+        yield [p[key] for key, _ in EXPORT_FIELDS]
+
+def write_csv(rows):
+    """Stream rows into an in-memory CSV file (UTF-8 with BOM so Excel keeps the emojis)"""
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow([header for _, header in EXPORT_FIELDS])
+    writer.writerows(rows)
+    text.flush()
+    text.detach()
+    buffer.seek(0)
+    return buffer
+
+def write_xlsx(rows):
+    """Stream rows into an in-memory XLSX workbook"""
+    from openpyxl import Workbook  # Only needed for exports, keep startup light
+    
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Census')
+    sheet.append([header for _, header in EXPORT_FIELDS])
+    for row in rows:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+# ============ MESSAGE DELIVERY ============
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Split text into ordered chunks that fit in one message, breaking at line ends"""
+    chunks = []
+    lines = []
+    length = 0
+    for line in text.split('\n'):
+        # Hard-wrap a line that can't fit in a message on its own
+        # (half the limit in characters, since an emoji takes two UTF-16 units)
+        while utf16_len(line) > limit:
+            if lines:
+                chunks.append('\n'.join(lines))
+                lines, length = [], 0
+            chunks.append(line[:limit // 2])
+            line = line[limit // 2:]
+        
+        line_length = utf16_len(line)
+        if lines and length + 1 + line_length > limit:
+            chunks.append('\n'.join(lines))
+            lines, length = [], 0
+        length += line_length + (1 if lines else 0)
+        lines.append(line)
+    
+    if lines:
+        chunks.append('\n'.join(lines))
+    return [chunk.strip('\n') for chunk in chunks if chunk.strip()]
+
+async def reply_chunked(message, text, code_block=False):
+    """Reply with text split across as many messages as needed, in order.
+    
+    With code_block, every chunk gets its own ``` block so the Markdown stays balanced.
+    """
+    if code_block:
+        # A stray backtick would close the code block early
+        text = text.replace('`', "'")
+        for chunk in split_message(text, TELEGRAM_MESSAGE_LIMIT - len("```\n\n```")):
+            await message.reply_text(f"```\n{chunk}\n```", parse_mode='Markdown')
+    else:
+        for chunk in split_message(text):
+            await message.reply_text(chunk)
+
 # ============ ADD PATIENT HANDLERS ============
 
 async def add_patient_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -281,29 +1177,70 @@ async def dispo_type_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def cwi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['cwi'] = update.message.text.strip()
-    context.user_data['special_cats'] = []
-    
-    # Create inline keyboard for special categories
-    keyboard = []
-    for emoji, desc in SPECIAL_CATS_MAP.items():
-        keyboard.append([InlineKeyboardButton(f"{emoji} - {desc}", callback_data=emoji)])
-    keyboard.append([InlineKeyboardButton("✅ Done", callback_data="done")])
+    context.user_data['special_cats_mask'] = 0
+    context.user_data['special_cats_shown'] = 0
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         "Select Special Categories (you can select multiple):",
-        reply_markup=reply_markup
+        reply_markup=special_cats_keyboard(0)
     )
     return SPECIAL_CATS
 
+@functools.lru_cache(maxsize=None)
+def special_cats_keyboard(mask):
+    """Keyboard for a selection bitmask - each state is built once and reused"""
+    keyboard = [selected if mask & bit else unselected
+                for bit, (unselected, selected) in zip(SPECIAL_CAT_BITS.values(), SPECIAL_CAT_ROWS)]
+    keyboard.append(SPECIAL_CATS_DONE_ROW)
+    return InlineKeyboardMarkup(keyboard)
+
+def special_cats_from_mask(mask):
+    return [emoji for emoji, bit in SPECIAL_CAT_BITS.items() if mask & bit]
+
+async def flush_special_cats_keyboard(query, user_data):
+    """Send the latest selection once taps have settled, one edit at a time, until the keyboard matches it.
+    
+    The task stays in user_data['special_cats_edit'] while it runs, so taps during a slow
+    edit are picked up by the next pass instead of starting a second, overlapping flush.
+    """
+    task = asyncio.current_task()
+    try:
+        while True:
+            await asyncio.sleep(SPECIAL_CATS_DEBOUNCE_SECONDS)
+            # "done" detaches the task when it takes over the message
+            if user_data.get('special_cats_edit') is not task:
+                return
+            mask = user_data.get('special_cats_mask', 0)
+            if mask == user_data.get('special_cats_shown', 0):
+                return
+            user_data['special_cats_sending'] = True
+            try:
+                await query.edit_message_reply_markup(reply_markup=special_cats_keyboard(mask))
+            except Exception as e:
+                print(f"⚠ Could not update special categories keyboard: {e}")
+                return
+            finally:
+                user_data.pop('special_cats_sending', None)
+            user_data['special_cats_shown'] = mask
+    finally:
+        if user_data.get('special_cats_edit') is task:
+            user_data.pop('special_cats_edit')
+
 async def special_cats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     if query.data == "done":
+        # The keyboard is about to be replaced - stop the flush, letting an edit in flight land first
+        flush = context.user_data.pop('special_cats_edit', None)
+        if flush:
+            if not context.user_data.get('special_cats_sending'):
+                flush.cancel()
+            await asyncio.gather(flush, return_exceptions=True)
+        
         # Format the patient entry
         data = context.user_data
-        special_cats_str = ' '.join(data.get('special_cats', []))
+        special_cats_str = ' '.join(special_cats_from_mask(data.get('special_cats_mask', 0)))
         
         patient_entry = (
             f"{data['gm_service']}/{data['last_name']} "
@@ -313,8 +1250,10 @@ async def special_cats_callback(update: Update, context: ContextTypes.DEFAULT_TY
         ).strip()
         
         # Add to Google Sheet
+        sheet = sheet_for(update, context)
         try:
-            ws = get_sheet()
+            # The cached worksheet's row_count can be stale, and add_rows() resizes from it
+            ws = refresh_worksheet(sheet)
             # Find the next empty row
             all_values = ws.get_all_values()
             next_row = len(all_values) + 1
@@ -324,25 +1263,37 @@ async def special_cats_callback(update: Update, context: ContextTypes.DEFAULT_TY
                 rows_to_add = 50  # Add 50 rows at a time
                 ws.add_rows(rows_to_add)
             
-            # Column A: Critical/Non-Crit formula
-            formula_a = f'=IF(I{next_row}="", "", IF(OR(ISNUMBER(SEARCH("🚨", I{next_row})), ISNUMBER(SEARCH("😱", I{next_row}))), "Critical", "Non-Crit"))'
-            
-            # Column B: Extract GM service formula
-            formula_b = f'=IF(I{next_row}="","",LEFT(I{next_row},3))'
-            
-            # Column D: Extract O2 support formula
-            formula_d = f'=IF(REGEXMATCH(I{next_row}, "\\(?(RA|NC|FM|TM|NRM|HFNC|BIPAP|ET)/"), REGEXEXTRACT(I{next_row}, "\\(?(RA|NC|FM|TM|NRM|HFNC|BIPAP|ET)"), "")'
+            if COMPUTE_COLUMNS:
+                value_a, value_b, value_d = computed_columns(patient_entry)
+            else:
+                # Column A: Critical/Non-Crit formula
+                value_a = f'=IF(I{next_row}="", "", IF(OR(ISNUMBER(SEARCH("🚨", I{next_row})), ISNUMBER(SEARCH("😱", I{next_row}))), "Critical", "Non-Crit"))'
+                
+                # Column B: Extract GM service formula
+                value_b = f'=IF(I{next_row}="","",LEFT(I{next_row},3))'
+                
+                # Column D: Extract O2 support formula
+                value_d = f'=IF(REGEXMATCH(I{next_row}, "\\(?(RA|NC|FM|TM|NRM|HFNC|BIPAP|ET)/"), REGEXEXTRACT(I{next_row}, "\\(?(RA|NC|FM|TM|NRM|HFNC|BIPAP|ET)"), "")'
             
-            # Update all cells
-            ws.update_cell(next_row, COL_CRITICAL, formula_a)
-            ws.update_cell(next_row, COL_GM, formula_b)
-            ws.update_cell(next_row, COL_D, formula_d)
-            ws.update_cell(next_row, COL_DISPO, data['dispo_type'])
-            ws.update_cell(next_row, COL_WARD_BED, f"{data['ward']}-{data['bed']}")
-            ws.update_cell(next_row, COL_PATIENT, patient_entry)
-            ws.update_cell(next_row, COL_JRIC, data['jric'])
-            ws.update_cell(next_row, COL_CWI, data['cwi'])
+            # Write the whole row in one request (None leaves a cell untouched)
+            row_values = [None] * COL_CWI
+            row_values[COL_CRITICAL-1] = value_a
+            row_values[COL_GM-1] = value_b
+            row_values[COL_D-1] = value_d
+            row_values[COL_DISPO-1] = data['dispo_type']
+            row_values[COL_WARD_BED-1] = f"{data['ward']}-{data['bed']}"
+            row_values[COL_PATIENT-1] = patient_entry
+            row_values[COL_JRIC-1] = data['jric']
+            row_values[COL_CWI-1] = data['cwi']
+            ws.update(
+                f"{rowcol_to_a1(next_row, 1)}:{rowcol_to_a1(next_row, COL_CWI)}",
+                [row_values],
+                value_input_option='USER_ENTERED'
+            )
             
+            index_patient_row(sheet, patient_id(patient_entry), next_row)
+            invalidate_census(sheet)
+            context.application.create_task(refresh_patient_index(sheet))
             await query.edit_message_text(f"✅ Patient added successfully!\n\n{patient_entry}\n\nDisposition: {data['dispo_type']}\nCWI: {data['cwi']}")
         except Exception as e:
             await query.edit_message_text(f"❌ Error adding patient: {str(e)}")
@@ -351,20 +1302,15 @@ async def special_cats_callback(update: Update, context: ContextTypes.DEFAULT_TY
         return ConversationHandler.END
     else:
         # Toggle special category
-        if query.data in context.user_data['special_cats']:
-            context.user_data['special_cats'].remove(query.data)
-        else:
-            context.user_data['special_cats'].append(query.data)
-        
-        # Update keyboard to show selected items
-        keyboard = []
-        for emoji, desc in SPECIAL_CATS_MAP.items():
-            selected = "✓ " if emoji in context.user_data['special_cats'] else ""
-            keyboard.append([InlineKeyboardButton(f"{selected}{emoji} - {desc}", callback_data=emoji)])
-        keyboard.append([InlineKeyboardButton("✅ Done", callback_data="done")])
+        context.user_data['special_cats_mask'] = (
+            context.user_data.get('special_cats_mask', 0) ^ SPECIAL_CAT_BITS.get(query.data, 0)
+        )
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_reply_markup(reply_markup=reply_markup)
+        # Coalesce fast taps - only the latest state is sent once they settle
+        if 'special_cats_edit' not in context.user_data:
+            context.user_data['special_cats_edit'] = context.application.create_task(
+                flush_special_cats_keyboard(query, context.user_data)
+            )
         
         return SPECIAL_CATS
 
@@ -373,21 +1319,26 @@ async def special_cats_callback(update: Update, context: ContextTypes.DEFAULT_TY
 async def dispo_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start disposition update - first select patient"""
     try:
-        patients = get_all_patients()
+        sheet = sheet_for(update, context)
+        patients = get_all_patients(sheet)
         
         if not patients:
             await update.message.reply_text("No patients found in the sheet.")
             return ConversationHandler.END
         
         # Create keyboard with patient list
+        ambiguous = get_census_cache(sheet)['ambiguous']
         keyboard = []
         for p in patients:
             # Show last name from patient entry
             display = p['patient'][:50] + "..." if len(p['patient']) > 50 else p['patient']
-            keyboard.append([InlineKeyboardButton(display, callback_data=f"patient_{p['row']}")])
+            # Shared IDs also carry the row, so the two buttons stay distinguishable
+            callback = f"patient_{p['id']}@{p['row']}" if p['id'] in ambiguous else f"patient_{p['id']}"
+            keyboard.append([InlineKeyboardButton(display, callback_data=callback)])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
         context.user_data['patients'] = patients
+        context.user_data['sheet'] = sheet
         
         await update.message.reply_text(
             "Select a patient to update disposition:",
@@ -403,8 +1354,17 @@ async def dispo_patient_callback(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     
-    row_num = int(query.data.replace("patient_", ""))
-    context.user_data['selected_row'] = row_num
+    selected = query.data.replace("patient_", "")
+    pid, _, row = selected.partition('@')
+    row_hint = int(row) if row else None
+    
+    # Remember exactly which entry was picked, to check the row before writing
+    for p in context.user_data.get('patients', []):
+        if p['id'] == pid and (row_hint is None or p['row'] == row_hint):
+            context.user_data['selected_entry'] = p['patient']
+            break
+    context.user_data['selected_id'] = pid
+    context.user_data['selected_row'] = row_hint
     
     # Show disposition options
     keyboard = [[InlineKeyboardButton(opt, callback_data=f"dispo_{opt}")] for opt in DISPO_OPTIONS]
@@ -422,11 +1382,25 @@ async def dispo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     dispo = query.data.replace("dispo_", "")
-    row_num = context.user_data.get('selected_row')
+    pid = context.user_data.get('selected_id')
+    sheet = context.user_data.get('sheet', DEFAULT_SHEET)
     
     try:
-        ws = get_sheet()
+        row_num = resolve_patient_row(
+            sheet, pid, context.user_data.get('selected_entry', ''), context.user_data.get('selected_row')
+        )
+        if row_num is None:
+            await query.edit_message_text(
+                "❌ Could not find this patient unambiguously - they may have been removed, "
+                "or another row has the same name and case number. Run /dispo again."
+            )
+            context.user_data.clear()
+            return ConversationHandler.END
+        
+        ws = get_sheet(sheet)
         ws.update_cell(row_num, COL_DISPO, dispo)
+        invalidate_census(sheet)
+        context.application.create_task(refresh_patient_index(sheet))
         
         await query.edit_message_text(f"✅ Disposition updated to: {dispo}")
     except Exception as e:
@@ -450,7 +1424,7 @@ async def search_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.message.text.strip()
     
     try:
-        patients = get_all_patients()
+        patients = get_all_patients(sheet_for(update, context))
         
         if not patients:
             await update.message.reply_text("No patients found in the sheet.")
@@ -503,6 +1477,35 @@ async def search_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer inline queries (@bot smith) from the in-process index"""
+    inline_query = update.inline_query
+    sheet = sheet_for(update, context)
+    
+    # Never fetch on a keystroke - refresh in the background and answer from what we have
+    if patient_index_is_stale(sheet):
+        context.application.create_task(refresh_patient_index(sheet))
+    
+    if not inline_query.query.strip():
+        await inline_query.answer([], cache_time=5)
+        return
+    
+    patient_index = get_patient_index(sheet)
+    patients = patient_index['patients']
+    results = []
+    for pos in search_patient_index(inline_query.query, sheet)[:INLINE_MAX_RESULTS]:
+        p = patients[pos]
+        code = extract_code(p['patient'])
+        cwi = p['cwi'] if p['cwi'] else "No assessment available"
+        results.append(InlineQueryResultArticle(
+            id=f"{patient_index['version']}-{pos}",
+            title=code[:100],
+            description=f"{p['dispo']} | {p['jric']} | {cwi}"[:100],
+            input_message_content=InputTextMessageContent(f"{code}\n{cwi}")
+        ))
+    
+    await inline_query.answer(results, cache_time=10, is_personal=True)
+
 def extract_code(patient_str):
     """Extract the full patient entry from column I"""
     # Return the full patient string instead of just case number/passcode
@@ -519,7 +1522,7 @@ async def search_by_jric(update: Update, patients, jric_name):
         code = extract_code(p['patient'])
         response += f"{code}\n"
     
-    await update.message.reply_text(response)
+    await reply_chunked(update.message, response)
 
 async def search_single_patient(update: Update, patient):
     """Display single patient details"""
@@ -559,100 +1562,114 @@ async def search_by_gm_service(update: Update, patients, service):
             response += f"{code}\n"
         response += "\n"
     
-    await update.message.reply_text(response)
+    await reply_chunked(update.message, response)
 
 # ============ SERVICE REPORT HANDLERS ============
 
 async def service_report_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Generate service report"""
-    await update.message.reply_text("Enter the GM service for the report (e.g., GM1):")
+    """Generate service report (/servicereport all - every GM service at once)"""
+    if context.args and context.args[0].lower() == 'all':
+        await send_service_report(update, context, 'all')
+        return ConversationHandler.END
+    await update.message.reply_text("Enter the GM service for the report (e.g., GM1, or 'all' for every service):")
     return SERVICE_REPORT
 
 async def generate_service_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    service = update.message.text.strip()
+    await send_service_report(update, context, update.message.text)
+    return ConversationHandler.END
+
+async def send_service_report(update: Update, context: ContextTypes.DEFAULT_TYPE, service):
+    """Send the census report for one GM service, or for all of them"""
+    service = service.strip().upper()
+    # Add GM prefix if not included
+    if service != 'ALL' and not service.startswith('GM'):
+        service = f"GM{service}"
     
     try:
-        patients = get_all_patients()
+        patients = get_all_patients(sheet_for(update, context))
         
         if not patients:
             await update.message.reply_text("No patients found in the sheet.")
-            return ConversationHandler.END
+            return
         
-        service_patients = [p for p in patients if p['gm_service'] == service]
+        # One grouping pass serves every service's report
+        service_groups = group_by_service(patients)
         
-        if not service_patients:
-            await update.message.reply_text(f"No patients found for service: {service}")
-            return ConversationHandler.END
+        if service == 'ALL':
+            reports = [build_service_report(s, service_groups[s]) for s in SERVICES if s in service_groups]
+            if not reports:
+                await update.message.reply_text("No patients found for any GM service.")
+                return
+            await reply_chunked(update.message, '\n\n'.join(reports), code_block=True)
+            return
         
-        # Count dispositions
-        old_count = sum(1 for p in service_patients if p['dispo'] == 'OLD')
-        
-        # Count advanced airway patients (🚨 emoji in patient string)
-        advanced_airway = [p for p in service_patients if '🚨' in p['patient']]
+        if service not in service_groups:
+            await update.message.reply_text(f"No patients found for service: {service}")
+            return
         
-        # Group by JRIC
-        jric_groups = {}
-        for p in service_patients:
-            # Extract JRIC from patient string (between [ ])
-            patient_str = p['patient']
-            jric_start = patient_str.find('[')
-            jric_end = patient_str.find(']', jric_start) if jric_start != -1 else -1
-            
-            if jric_start != -1 and jric_end != -1 and jric_end > jric_start:
-                jric = patient_str[jric_start+1:jric_end]
-                if jric not in jric_groups:
-                    jric_groups[jric] = []
-                jric_groups[jric].append(p)
-        
-        # Count admissions/discharges
-        admitted = sum(1 for p in service_patients if p['dispo'] == 'ADMITTED')
-        trans_in_icu = sum(1 for p in service_patients if p['dispo'] == 'TRANS IN FROM ICU')
-        tos_in = sum(1 for p in service_patients if p['dispo'] == 'TOS IN')
-        
-        home = sum(1 for p in service_patients if p['dispo'] == 'HOME')
-        hama = sum(1 for p in service_patients if p['dispo'] == 'HAMA/HPR')
-        trans_out_icu = sum(1 for p in service_patients if p['dispo'] == 'TRANS OUT TO ICU')
-        mort = sum(1 for p in service_patients if p['dispo'] == 'MORT')
-        thoc = sum(1 for p in service_patients if p['dispo'] == 'THOC')
-        abscond = sum(1 for p in service_patients if p['dispo'] == 'ABSCOND')
-        
-        # Calculate total
-        additions = admitted + trans_in_icu + tos_in
-        subtractions = home + hama + trans_out_icu + mort + thoc + abscond
-        total = old_count + additions - subtractions
-        
-        # Build report
-        report = f"GM{service} WARD CENSUS\n"
-        report += f"DATE {datetime.now().strftime('%m/%d/%y')}\n"
-        report += f"RECEIVED: {old_count}\n\n"
-        
-        # JRIC groups
-        for jric, pts in jric_groups.items():
-            advanced_in_jric = sum(1 for p in pts if '🚨' in p['patient'])
-            report += f"{jric} ({len(pts)} | {advanced_in_jric})\n"
-            
-            # List patient codes
-            for p in pts:
-                # Extract case number/passcode
-                patient_str = p['patient']
-                dash_parts = patient_str.split(' - ')
-                if len(dash_parts) >= 2:
-                    code = dash_parts[1].split(' - ')[0]
-                    report += f"{code}\n"
-            report += "\n"
-        
-        report += f"{service} = {old_count} + {additions} - {subtractions} = {total}"
-        
-        await update.message.reply_text(f"```\n{report}\n```", parse_mode='Markdown')
+        report = build_service_report(service, service_groups[service])
+        await reply_chunked(update.message, report, code_block=True)
     except Exception as e:
         await update.message.reply_text(f"Error generating report: {str(e)}")
+
+def group_by_service(patients):
+    """Bucket patients by GM service in a single pass"""
+    groups = {}
+    for p in patients:
+        groups.setdefault(p['gm_service'], []).append(p)
+    return groups
+
+def build_service_report(service, service_patients):
+    """Build the ward census report for one service's patients"""
+    dispo_counts = Counter()
+    jric_groups = {}
+    for p in service_patients:
+        dispo_counts[p['dispo']] += 1
+        
+        # Extract JRIC from patient string (between [ ])
+        patient_str = p['patient']
+        jric_start = patient_str.find('[')
+        jric_end = patient_str.find(']', jric_start) if jric_start != -1 else -1
+        
+        if jric_start != -1 and jric_end != -1 and jric_end > jric_start:
+            jric_groups.setdefault(patient_str[jric_start+1:jric_end], []).append(p)
     
-    return ConversationHandler.END
+    # Count admissions/discharges
+    old_count = dispo_counts['OLD']
+    additions = dispo_counts['ADMITTED'] + dispo_counts['TRANS IN FROM ICU'] + dispo_counts['TOS IN']
+    subtractions = (dispo_counts['HOME'] + dispo_counts['HAMA/HPR'] + dispo_counts['TRANS OUT TO ICU'] +
+                    dispo_counts['MORT'] + dispo_counts['THOC'] + dispo_counts['ABSCOND'])
+    total = old_count + additions - subtractions
+    
+    # Build report
+    report = f"{service} WARD CENSUS\n"
+    report += f"DATE {datetime.now().strftime('%m/%d/%y')}\n"
+    report += f"RECEIVED: {old_count}\n\n"
+    
+    # JRIC groups
+    for jric, pts in jric_groups.items():
+        advanced_in_jric = sum(1 for p in pts if '🚨' in p['patient'])
+        report += f"{jric} ({len(pts)} | {advanced_in_jric})\n"
+        
+        # List patient codes
+        for p in pts:
+            # Extract case number/passcode
+            dash_parts = p['patient'].split(' - ')
+            if len(dash_parts) >= 2:
+                report += f"{dash_parts[1]}\n"
+        report += "\n"
+    
+    report += f"{service} = {old_count} + {additions} - {subtractions} = {total}"
+    return report
 
 # ============ GALA WARDS REPORT HANDLERS ============
 
 async def galawards_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Start Gala Wards report"""
+    """Start Gala Wards report (/galawardsreport all - combine every configured sheet)"""
+    if context.args and context.args[0].lower() == 'all':
+        context.user_data['gala_sheets'] = list(SHEETS)
+    else:
+        context.user_data['gala_sheets'] = [sheet_for(update, context)]
     await update.message.reply_text("Enter Admitting service:")
     context.user_data['gala_step'] = 'service'
     return GALAWARDS_INPUTS
@@ -681,8 +1698,9 @@ async def galawards_inputs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Generate report
         try:
-            report = generate_galawards_report(context.user_data)
-            await update.message.reply_text(f"```\n{report}\n```", parse_mode='Markdown')
+            patients_by_sheet = await fetch_all_sheets(context.user_data['gala_sheets'])
+            report = generate_galawards_report(context.user_data, patients_by_sheet)
+            await reply_chunked(update.message, report, code_block=True)
         except Exception as e:
             await update.message.reply_text(f"Error generating report: {str(e)}")
         
@@ -691,24 +1709,22 @@ async def galawards_inputs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return GALAWARDS_INPUTS
 
-def generate_galawards_report(data):
-    """Generate the Gala Wards report"""
-    patients = get_all_patients()
+def census_counts(patients):
+    """Return (old, additions, subtractions, total) for a list of patients"""
+    old_count = sum(1 for p in patients if p['dispo'] == 'OLD')
+    additions = sum(1 for p in patients if p['dispo'] in ADDITION_DISPOS)
+    subtractions = sum(1 for p in patients if p['dispo'] in SUBTRACTION_DISPOS)
+    return old_count, additions, subtractions, old_count + additions - subtractions
+
+def generate_galawards_report(data, patients_by_sheet):
+    """Generate the Gala Wards report across one or more sheets ({sheet name: patients})"""
+    patients = [p for sheet_patients in patients_by_sheet.values() for p in sheet_patients]
     
     # Count OLD patients
     old_total = sum(1 for p in patients if p['dispo'] == 'OLD')
     
-    # Helper function to extract last name from patient string
-    def get_last_name(patient_str):
-        # Format: GM#/LastName (...)
-        parts = patient_str.split('/')
-        if len(parts) >= 2:
-            name_part = parts[1].split('(')[0].strip()
-            return name_part
-        return ""
-    
     # Process each GM service
-    services = ['GM1', 'GM2', 'GM3', 'GM4', 'GM5', 'GM6']
+    services = SERVICES
     
     report = "SERVICE AND WARD CENSUS\n"
     report += f"Admitting service: {data['admitting_service']}\n"
@@ -809,30 +1825,186 @@ def generate_galawards_report(data):
     total_all = 0
     for service in services:
         service_patients = [p for p in patients if p['gm_service'] == service]
-        old_count = sum(1 for p in service_patients if p['dispo'] == 'OLD')
-        additions = sum(1 for p in service_patients if p['dispo'] in ['ADMITTED', 'TOS IN', 'TRANS IN FROM ICU'])
-        subtractions = sum(1 for p in service_patients if p['dispo'] in ['HOME', 'TOS OUT', 'TRANS OUT TO ICU', 'HAMA/HPR', 'THOC', 'ABSCOND', 'MORT'])
-        total = old_count + additions - subtractions
+        old_count, additions, subtractions, total = census_counts(service_patients)
         total_all += total
         
         report += f"{service}: {old_count} + {additions} - {subtractions} = {total}\n"
     
+    # Per-ward breakdown when several sheets were combined
+    if len(patients_by_sheet) > 1:
+        report += "\nWARD CENSUS\n"
+        for sheet, sheet_patients in patients_by_sheet.items():
+            service_patients = [p for p in sheet_patients if p['gm_service'] in services]
+            old_count, additions, subtractions, total = census_counts(service_patients)
+            report += f"{sheet}: {old_count} + {additions} - {subtractions} = {total}\n"
+    
     report += f"\nTOTAL: {total_all}"
     
     return report
 
+async def trend(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Census trend from the local history (/trend GM3 30d)"""
+    if not context.args:
+        await update.message.reply_text("Usage: /trend GM3 30d (or /trend all 7d)")
+        return
+    
+    service = context.args[0].upper()
+    if service != 'ALL' and not service.startswith('GM'):
+        service = f"GM{service}"
+    try:
+        days = int(context.args[1].lower().rstrip('d')) if len(context.args) > 1 else 30
+    except ValueError:
+        await update.message.reply_text("Days must be a number, e.g. 30d")
+        return
+    
+    sheet = sheet_for(update, context)
+    try:
+        rows = census_trend(sheet, service, days)
+    except Exception as e:
+        await update.message.reply_text(f"Error reading history: {str(e)}")
+        return
+    
+    if not rows:
+        await update.message.reply_text(f"No history for {service} in the last {days} days.")
+        return
+    
+    report = f"{service} CENSUS TREND ({days}d)\n"
+    for day, old_count, additions, subtractions in rows:
+        day_str = datetime.strptime(day, '%Y-%m-%d').strftime('%m/%d/%y')
+        report += f"{day_str}: {old_count} + {additions} - {subtractions} = {old_count + additions - subtractions}\n"
+    await reply_chunked(update.message, report, code_block=True)
+
+async def length_of_stay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Length of stay of current patients from the local history (/los [name, GM# or JRIC])"""
+    keyword = ' '.join(context.args) if context.args else ''
+    sheet = sheet_for(update, context)
+    try:
+        stays = lengths_of_stay(sheet, keyword)
+    except Exception as e:
+        await update.message.reply_text(f"Error reading history: {str(e)}")
+        return
+    
+    if not stays:
+        await update.message.reply_text("No matching patients in the census history.")
+        return
+    
+    report = "LENGTH OF STAY (days)\n"
+    for days, patient in stays:
+        report += f"{days:>3}  {patient}\n"
+    await reply_chunked(update.message, report, code_block=True)
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the census as a file (/export [csv|xlsx] [GM#] [jric=NAME] [dispo=TOS_IN])"""
+    fmt = 'csv'
+    filters_used = {}
+    for arg in context.args or []:
+        if arg.lower() in ('csv', 'xlsx'):
+            fmt = arg.lower()
+        elif '=' in arg and arg.split('=', 1)[0].lower() in ('jric', 'dispo'):
+            key, value = arg.split('=', 1)
+            filters_used[key.lower()] = value.replace('_', ' ')
+        elif arg.upper().startswith('GM') or arg.isdigit():
+            filters_used['service'] = arg.upper() if arg.upper().startswith('GM') else f"GM{arg}"
+        else:
+            await update.message.reply_text(
+                "Usage: /export [csv|xlsx] [GM#] [jric=NAME] [dispo=TOS_IN]"
+            )
+            return
+    
+    sheet = sheet_for(update, context)
+    try:
+        # Serve from the in-process census; only fetch when there is no fresh copy
+        patients = cached_patients(sheet)
+        if patients is None:
+            patients = await asyncio.to_thread(get_all_patients, sheet)
+        rows = export_rows(
+            patients,
+            service=filters_used.get('service'),
+            jric=filters_used.get('jric'),
+            dispo=filters_used.get('dispo', '').upper() or None
+        )
+        buffer = write_xlsx(rows) if fmt == 'xlsx' else write_csv(rows)
+        
+        filename = f"census_{sheet}_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}"
+        await update.message.reply_document(document=buffer, filename=filename)
+    except Exception as e:
+        await update.message.reply_text(f"Error exporting census: {str(e)}")
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin: /profile on [handler ...] | off | report | dump | clear"""
+    if not is_admin(update):
+        await update.message.reply_text("This command is for admins only.")
+        return
+    
+    action = context.args[0].lower() if context.args else 'report'
+    if action == 'on':
+        profiling['enabled'] = True
+        profiling['handlers'] = set(context.args[1:])
+        scope = ', '.join(sorted(profiling['handlers'])) or 'all handlers'
+        await update.message.reply_text(f"Profiling on for {scope}.")
+    elif action == 'off':
+        profiling['enabled'] = False
+        await update.message.reply_text("Profiling off. Use /profile report to see results.")
+    elif action == 'report':
+        await reply_chunked(update.message, profile_report(), code_block=True)
+    elif action == 'dump':
+        try:
+            count = await asyncio.to_thread(dump_profiles)
+            await update.message.reply_text(f"Wrote {count} profiles to {os.path.abspath(PROFILE_DIR)}")
+        except Exception as e:
+            await update.message.reply_text(f"❌ Error writing profiles: {str(e)}")
+    elif action == 'clear':
+        profiling['slowest'] = []
+        await update.message.reply_text("Profiles cleared.")
+    else:
+        await update.message.reply_text("Usage: /profile on [handler ...] | off | report | dump | clear")
+
+async def migrate_formulas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin: replace the Critical/GM/O2 formulas in this chat's sheet with plain values"""
+    if not is_admin(update):
+        await update.message.reply_text("This command is for admins only.")
+        return
+    
+    sheet = sheet_for(update, context)
+    await update.message.reply_text(f"Replacing formulas in '{sheet}'...")
+    try:
+        count = await asyncio.to_thread(replace_formulas_with_values, sheet)
+        note = "" if COMPUTE_COLUMNS else "\n\n⚠ Set COMPUTE_COLUMNS=1 so new patients are added with values too."
+        await update.message.reply_text(f"✅ Replaced formulas with values ({count} patients).{note}")
+    except Exception as e:
+        await update.message.reply_text(f"❌ Error migrating formulas: {str(e)}")
+
+async def select_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or switch the sheet this chat works on (/sheet wardA)"""
+    if context.args:
+        name = context.args[0]
+        if name not in SHEETS:
+            await update.message.reply_text(f"Unknown sheet: {name}\nAvailable: {', '.join(SHEETS)}")
+            return
+        context.chat_data['sheet'] = name
+    
+    current = sheet_for(update, context)
+    await update.message.reply_text(f"Using sheet: {current}\nAvailable: {', '.join(SHEETS)}")
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the current operation"""
     context.user_data.clear()
     await update.message.reply_text("Operation cancelled.")
     return ConversationHandler.END
 
+async def post_init(application: Application):
+    """Warm the inline search indexes before the first query arrives"""
+    for sheet in SHEETS:
+        application.create_task(refresh_patient_index(sheet))
+    if SNAPSHOT_ROLE == 'writer':
+        application.create_task(snapshot_writer_loop())
+
 def main():
     """Main function to run the bot"""
     # Replace with your bot token
     TOKEN = "YOUR_BOT_TOKEN_HERE"
     
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_init(post_init).build()
     
     # Add patient conversation handler
     add_conv = ConversationHandler(
@@ -892,14 +2064,29 @@ def main():
     )
     
     application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('sheet', select_sheet))
+    application.add_handler(CommandHandler('migrateformulas', migrate_formulas))
+    application.add_handler(CommandHandler('trend', trend))
+    application.add_handler(CommandHandler('los', length_of_stay))
+    application.add_handler(CommandHandler('export', export))
     application.add_handler(add_conv)
     application.add_handler(dispo_conv)
     application.add_handler(service_conv)
     application.add_handler(gala_conv)
     application.add_handler(search_conv)
+    application.add_handler(InlineQueryHandler(inline_search))
+    
+    # /profile itself is registered after wrapping, so it never shows up in its own report
+    install_profiling(application)
+    application.add_handler(CommandHandler('profile', profile))
     
     print("Bot is running...")
     application.run_polling()
 
 if __name__ == '__main__':
-    main()
+    if '--snapshot-writer' in sys.argv:
+        # Sidecar mode: only refresh the shared snapshots, no Telegram polling
+        SNAPSHOT_ROLE = 'writer'
+        asyncio.run(snapshot_writer_loop())
+    else:
+        main()